@@ -16,17 +16,37 @@ Important:
   point clouds already in the Metashape project (otherwise yaw/axis conventions can differ).
 """
 
+import contextlib
+import functools
+import io
 import os
+import sys
 import Metashape
 
 
+# Set TLS_REPLACE_DEBUG=1 to print the 4x4 transforms (source, imported, DELTA, final) per scan
+_DEBUG = os.environ.get("TLS_REPLACE_DEBUG") == "1"
+
+
 # -----------------------------------------------------------------------------
 # Small utility helpers
 # -----------------------------------------------------------------------------
 
+@functools.lru_cache(maxsize=4096)
 def _norm_name(s: str) -> str:
-    """Normalize a name for robust matching (trim + lower)."""
-    return (s or "").strip().lower()
+    """Normalize a name for robust matching (trim + casefold). Memoized."""
+    return (s or "").strip().casefold()
+
+
+@contextlib.contextmanager
+def _buffered_stdout():
+    """Collect console output in memory and write it to stdout in a single call on exit."""
+    buf = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(buf):
+            yield buf
+    finally:
+        sys.stdout.write(buf.getvalue())
 
 
 def _get_e57_format():
@@ -39,15 +59,20 @@ def _get_e57_format():
 
 
 def _make_unique_label(desired: str, existing_lower: set) -> str:
-    """Ensure the label is unique inside the chunk by appending _02, _03, ..."""
-    if desired.lower() not in existing_lower:
+    """
+    Ensure the label is unique inside the chunk by appending _02, _03, ...
+
+    existing_lower holds labels normalized with _norm_name.
+    """
+    if _norm_name(desired) not in existing_lower:
         return desired
 
+    # Normalize the "<desired>_" stem once; probes only append the numeric suffix
+    stem_lower = _norm_name(desired + "_")
     i = 2
     while True:
-        candidate = f"{desired}_{i:02d}"
-        if candidate.lower() not in existing_lower:
-            return candidate
+        if f"{stem_lower}{i:02d}" not in existing_lower:
+            return f"{desired}_{i:02d}"
         i += 1
 
 
@@ -63,24 +88,53 @@ def _copy_matrix(M):
         return M
 
 
+def _rigid_inv(M, tol: float = 1e-9):
+    """
+    Inverse of a rigid 4x4 transform [R | t] computed in closed form as [R^T | -R^T t].
+
+    Falls back to the generic M.inv() when M is not rigid (scale/shear present or the last
+    row is not [0 0 0 1]).
+    """
+    R = [[M[r, c] for c in range(3)] for r in range(3)]
+    tx, ty, tz = M[0, 3], M[1, 3], M[2, 3]
+
+    # Rigid check: homogeneous last row and orthonormal rotation block (R * R^T == I)
+    if any(abs(M[3, c]) > tol for c in range(3)) or abs(M[3, 3] - 1.0) > tol:
+        return M.inv()
+    for i in range(3):
+        for j in range(3):
+            dot = R[i][0] * R[j][0] + R[i][1] * R[j][1] + R[i][2] * R[j][2]
+            if abs(dot - (1.0 if i == j else 0.0)) > tol:
+                return M.inv()
+
+    return Metashape.Matrix([
+        [R[0][0], R[1][0], R[2][0], -(R[0][0] * tx + R[1][0] * ty + R[2][0] * tz)],
+        [R[0][1], R[1][1], R[2][1], -(R[0][1] * tx + R[1][1] * ty + R[2][1] * tz)],
+        [R[0][2], R[1][2], R[2][2], -(R[0][2] * tx + R[1][2] * ty + R[2][2] * tz)],
+        [0.0, 0.0, 0.0, 1.0],
+    ])
+
+
 def _mat_to_str(M, digits: int = 6) -> str:
     """Pretty-print a 4x4 matrix for console debugging."""
     if M is None:
         return "None"
-    rows = []
-    for r in range(4):
-        row = []
-        for c in range(4):
-            v = M[r, c]
+    vals = [M[r, c] for r in range(4) for c in range(4)]
+    fmt = ("{: ." + str(digits) + "f}").format
+    try:
+        cells = [fmt(v) for v in vals]
+    except (TypeError, ValueError):
+        # Non-numeric entries: fall back to per-value conversion
+        cells = []
+        for v in vals:
             try:
-                row.append(f"{float(v): .{digits}f}")
+                cells.append(fmt(float(v)))
             except Exception:
-                row.append(str(v))
-        rows.append("[ " + "  ".join(row) + " ]")
-    return "\n".join(rows)
+                cells.append(str(v))
+    return "\n".join("[ " + "  ".join(cells[r * 4:r * 4 + 4]) + " ]" for r in range(4))
 
 
-def _effective_T(pc):
+def _effective_T(pc, T=None):
     """
     Effective transform used for pose comparisons when PointCloudGroup is involved:
 
@@ -89,8 +143,11 @@ def _effective_T(pc):
     If the point cloud has no group (or no group transform), then:
 
         T_eff = pc.transform
+
+    T may be passed if pc.transform was already read by the caller.
     """
-    T = getattr(pc, "transform", None)
+    if T is None:
+        T = getattr(pc, "transform", None)
     if T is None:
         return None
 
@@ -101,13 +158,16 @@ def _effective_T(pc):
     return T
 
 
-def _apply_delta_to_pc_transform(pc, delta):
+def _apply_delta_to_pc_transform(pc, delta, T=None):
     """
     Apply the delta in a multiplicative way (do not overwrite the transform frame):
 
         pc.transform := delta * pc.transform
+
+    T may be passed if pc.transform was already read by the caller.
     """
-    T = getattr(pc, "transform", None)
+    if T is None:
+        T = getattr(pc, "transform", None)
     if T is None:
         return
     pc.transform = delta * T
@@ -117,40 +177,58 @@ def _apply_delta_to_pc_transform(pc, delta):
 # Camera association + mask utilities
 # -----------------------------------------------------------------------------
 
-def _camera_belongs_to_pointcloud(cam, pc) -> bool:
+def _camera_pointcloud_key(cam):
     """
-    Best-effort association: determine whether a camera belongs to a given point cloud (TLS).
+    Best-effort association: return the key of the point cloud (TLS) a camera belongs to,
+    or None if it cannot be determined.
 
     Metashape builds differ, so we try multiple possible link properties.
     """
     # Most direct (if exposed):
     try:
-        if getattr(cam, "point_cloud", None) == pc:
-            return True
+        link = getattr(cam, "point_cloud", None)
+        if link is not None:
+            return getattr(link, "key", link)
     except Exception:
         pass
 
     # Some builds expose dense_cloud_id that may match point cloud key:
     try:
-        if getattr(cam, "dense_cloud_id", None) == getattr(pc, "key", None):
-            return True
+        return getattr(cam, "dense_cloud_id", None)
     except Exception:
         pass
 
-    return False
+    return None
 
 
-def _attached_cameras(chunk, pc):
+def _index_cameras_by_pointcloud(cameras):
     """
-    Return cameras associated with the given TLS point cloud, sorted for stable pairing.
+    Group cameras by the key of their associated TLS point cloud in a single pass.
+
+    Each list is sorted by (label, key) for stable pairing.
     """
-    cams = []
-    for cam in getattr(chunk, "cameras", []) or []:
-        if _camera_belongs_to_pointcloud(cam, pc):
-            cams.append(cam)
+    # Sort keys are read once per camera, in this pass
+    decorated = {}
+    for cam in cameras or []:
+        pc_key = _camera_pointcloud_key(cam)
+        if pc_key is None:
+            continue
+        decorated.setdefault(pc_key, []).append(
+            ((getattr(cam, "label", "") or ""), getattr(cam, "key", 0), cam)
+        )
+
+    cams_by_pc = {}
+    for pc_key, entries in decorated.items():
+        entries.sort(key=lambda e: (e[0], e[1]))
+        cams_by_pc[pc_key] = [cam for _, _, cam in entries]
+    return cams_by_pc
+
 
-    cams.sort(key=lambda c: ((getattr(c, "label", "") or ""), getattr(c, "key", 0)))
-    return cams
+def _attached_cameras(cams_by_pc, pc):
+    """
+    Return cameras associated with the given TLS point cloud, sorted for stable pairing.
+    """
+    return cams_by_pc.get(getattr(pc, "key", None), [])
 
 
 def _copy_mask(mask_obj):
@@ -204,19 +282,19 @@ def _clear_camera_mask(cam) -> bool:
     return False
 
 
-def _transfer_masks_from_src_to_new(chunk, src_pc, new_pc):
+def _transfer_masks_from_src_to_new(cams_by_pc, src_pc, new_pc):
     """
     Remove masks on NEW station cameras, then copy masks from SRC station cameras.
 
     Pairing strategy:
-    - Collect cameras attached to src_pc and new_pc (best-effort association).
+    - Look up cameras attached to src_pc and new_pc in the camera index (best-effort association).
     - Sort cameras by (label, key) for stable deterministic pairing.
-    - Copy mask by index: src_cams[i].mask -> new_cams[i].mask
+    - Copy mask pairwise by position: src_cams[i].mask -> new_cams[i].mask
 
     If counts differ, copy the common subset and print a warning.
     """
-    src_cams = _attached_cameras(chunk, src_pc)
-    new_cams = _attached_cameras(chunk, new_pc)
+    src_cams = _attached_cameras(cams_by_pc, src_pc)
+    new_cams = _attached_cameras(cams_by_pc, new_pc)
 
     print(f"  Cameras attached | SRC: {len(src_cams)} | NEW: {len(new_cams)}")
 
@@ -234,13 +312,13 @@ def _transfer_masks_from_src_to_new(chunk, src_pc, new_pc):
 
     n = min(len(src_cams), len(new_cams))
     copied = 0
-    for i in range(n):
-        src_mask = getattr(src_cams[i], "mask", None)
+    for src_cam, new_cam in zip(src_cams, new_cams):
+        src_mask = getattr(src_cam, "mask", None)
         if src_mask is None:
             # Nothing to copy for this camera
             continue
         try:
-            new_cams[i].mask = _copy_mask(src_mask)
+            new_cam.mask = _copy_mask(src_mask)
             copied += 1
         except Exception:
             # If assignment fails, keep going
@@ -263,7 +341,7 @@ def importar_e57_y_aplicar_delta_y_mascaras():
     - Apply transform DELTA to match existing station pose
     - Clear masks on imported stations
     - Copy masks from original stations to imported stations
-    - Print matrices for debugging
+    - Print matrices for debugging (only when TLS_REPLACE_DEBUG=1)
     """
     doc = Metashape.app.document
     if not doc or not doc.chunk:
@@ -284,48 +362,71 @@ def importar_e57_y_aplicar_delta_y_mascaras():
         print("Operation cancelled (no folder selected).")
         return
 
-    e57_files = sorted([
-        f for f in os.listdir(folder)
-        if os.path.isfile(os.path.join(folder, f)) and f.lower().endswith(".e57")
-    ])
+    # Single directory pass: DirEntry.is_file() is served from the listing (no extra stat).
+    # ".e57"/".E57" covers every casing of the extension (only "e" is a letter), no lower() needed.
+    with os.scandir(folder) as it:
+        e57_files = sorted(
+            e.name for e in it
+            if e.name.endswith((".e57", ".E57")) and e.is_file()
+        )
     if not e57_files:
         print(f"No .e57 files found in: {folder}")
         return
 
     pcs = getattr(chunk, "point_clouds", None) or []
-    laser_scans = [pc for pc in pcs if getattr(pc, "is_laser_scan", False)]
-    if not laser_scans:
-        print("No TLS laser scans found in the active chunk.")
-        return
-
-    # Map existing stations by normalized label
+    # Single pass over point clouds: existing labels and keys (all assets) + TLS stations by label
     loaded_by_name = {}
-    for pc in laser_scans:
-        k = _norm_name(getattr(pc, "label", ""))
+    existing_labels_lower = set()
+    known_pc_keys = set()
+    n_laser_scans = 0
+    for pc in pcs:
+        known_pc_keys.add(pc.key)
+        label = getattr(pc, "label", "") or ""
+        k = _norm_name(label)
+        if k:
+            existing_labels_lower.add(k)
+        if not getattr(pc, "is_laser_scan", False):
+            continue
+        n_laser_scans += 1
         if not k:
             continue
         if k in loaded_by_name:
-            print(f"WARNING: Duplicate scan label '{pc.label}'. The first one will be used.")
+            print(f"WARNING: Duplicate scan label '{label}'. The first one will be used.")
             continue
         loaded_by_name[k] = pc
 
-    existing_labels_lower = {_norm_name(getattr(pc, "label", "")) for pc in pcs if getattr(pc, "label", "")}
+    if not n_laser_scans:
+        print("No TLS laser scans found in the active chunk.")
+        return
+
     fmt_e57 = _get_e57_format()
 
+    # Index cameras by point cloud once; after each import only cameras not seen yet are indexed
+    cameras = getattr(chunk, "cameras", None) or []
+    cams_by_pc = _index_cameras_by_pointcloud(cameras)
+    indexed_cam_keys = {cam.key for cam in cameras}
+
     print(f"Chunk: {chunk.label!r}")
     print(f"Folder: {folder}")
     print(f"E57 files found: {len(e57_files)}")
-    print(f"TLS scans in chunk: {len(laser_scans)}\n")
+    print(f"TLS scans in chunk: {n_laser_scans}\n")
 
-    for fname in e57_files:
-        base = os.path.splitext(fname)[0]
-        key = _norm_name(base)
+    # Hash files by normalized base name once, then probe per station (stations << files).
+    # Matched files are still processed in sorted filename order.
+    file_keys = [_norm_name(os.path.splitext(fname)[0]) for fname in e57_files]
+    file_key_set = set(file_keys)
+    matched_keys = {key for key in loaded_by_name if key in file_key_set}
 
-        if key not in loaded_by_name:
+    for fname, key in zip(e57_files, file_keys):
+        if key not in matched_keys:
             continue
 
+        base = os.path.splitext(fname)[0]
         src = loaded_by_name[key]
-        if getattr(src, "transform", None) is None:
+
+        # Printed unbuffered so the console shows which file is being imported
+        T_src_pc = getattr(src, "transform", None)
+        if T_src_pc is None:
             print(f"SKIP '{fname}': '{src.label}' has no transform.")
             continue
 
@@ -333,21 +434,20 @@ def importar_e57_y_aplicar_delta_y_mascaras():
         print(f"MATCH: '{fname}' <-> '{src.label}' (src key={src.key})")
 
         # Source transforms
-        T_src_eff = _copy_matrix(_effective_T(src))
-        T_src_pc = _copy_matrix(getattr(src, "transform", None))
+        T_src_eff = _copy_matrix(_effective_T(src, T_src_pc))
 
         if T_src_eff is None:
             print("SKIP: Could not compute source effective transform (T_src_eff).")
             continue
 
-        print("\n(1) ORIGINAL POINT CLOUD IN METASHAPE")
-        print("SRC pc.transform:")
-        print(_mat_to_str(T_src_pc))
-        print("SRC effective (group*pc if applicable):")
-        print(_mat_to_str(T_src_eff))
+        if _DEBUG:
+            print("\n(1) ORIGINAL POINT CLOUD IN METASHAPE")
+            print("SRC pc.transform:")
+            print(_mat_to_str(T_src_pc))
+            print("SRC effective (group*pc if applicable):")
+            print(_mat_to_str(T_src_eff))
 
-        # Import
-        before_keys = {pc.key for pc in (getattr(chunk, "point_clouds", None) or [])}
+        # Import (known_pc_keys tracks every asset key seen so far, no "before" snapshot needed)
         chunk.importPointCloud(
             path=os.path.join(folder, fname),
             format=fmt_e57,
@@ -355,72 +455,84 @@ def importar_e57_y_aplicar_delta_y_mascaras():
             replace_asset=False
         )
 
-        after_pcs = getattr(chunk, "point_clouds", None) or []
-        new_pcs = [pc for pc in after_pcs if pc.key not in before_keys]
-        if not new_pcs:
-            print("ERROR: No new PointCloud assets detected after import.")
-            continue
-
-        # Process each imported PC (some E57 may generate multiple assets)
-        for idx, new_pc in enumerate(new_pcs, start=1):
-
-            # Labeling
-            desired = f"{base}_new" if idx == 1 else f"{base}_new_{idx:02d}"
-            new_label = _make_unique_label(desired, existing_labels_lower)
-            new_pc.label = new_label
-            existing_labels_lower.add(_norm_name(new_pc.label))
-
-            # Put imported scan in the same group as the source (for consistent effective transforms)
-            try:
-                if getattr(src, "group", None) is not None:
-                    new_pc.group = src.group
-            except Exception:
-                pass
-
-            # (2) Imported transforms (raw)
-            T_new0_pc = _copy_matrix(getattr(new_pc, "transform", None))
-            T_new0_eff = _copy_matrix(_effective_T(new_pc))
-
-            print("\n(2) IMPORTED POINT CLOUD (RAW)")
-            print(f"IMPORTED pc.transform (label='{new_pc.label}', key={new_pc.key}):")
-            print(_mat_to_str(T_new0_pc))
-            print("IMPORTED effective (group*pc if applicable):")
-            print(_mat_to_str(T_new0_eff))
-
-            if T_new0_eff is None:
-                print("ERROR: Could not compute imported effective transform (T_new0_eff).")
+        # Collect the post-import console output of this station and write it in one call
+        with _buffered_stdout():
+            pcs_after = chunk.point_clouds or []
+            new_pcs = [pc for pc in pcs_after if pc.key not in known_pc_keys]
+            known_pc_keys.update(pc.key for pc in new_pcs)
+            if not new_pcs:
+                print("ERROR: No new PointCloud assets detected after import.")
                 continue
 
-            # Delta so that DELTA * imported_eff == src_eff
-            delta = T_src_eff * T_new0_eff.inv()
-
-            print("\nDELTA = SRC_eff * inv(IMPORTED_eff):")
-            print(_mat_to_str(delta))
-
-            # Apply delta
-            _apply_delta_to_pc_transform(new_pc, delta)
-
-            # (3) Final transforms
-            T_newF_pc = _copy_matrix(getattr(new_pc, "transform", None))
-            T_newF_eff = _copy_matrix(_effective_T(new_pc))
-
-            print("\n(3) IMPORTED POINT CLOUD (FINAL AFTER DELTA)")
-            print("FINAL pc.transform:")
-            print(_mat_to_str(T_newF_pc))
-            print("FINAL effective (group*pc if applicable):")
-            print(_mat_to_str(T_newF_eff))
-
-            # Operational: keep enabled state
-            try:
-                new_pc.enabled = src.enabled
-            except Exception:
-                pass
-
-            # --- Mask transfer: clear NEW masks, then copy masks from SRC station to NEW station ---
-            print("\n(4) MASK TRANSFER (SRC -> NEW)")
-            _transfer_masks_from_src_to_new(chunk, src, new_pc)
-
-        print("=" * 90)
+            new_cams = [cam for cam in (chunk.cameras or []) if cam.key not in indexed_cam_keys]
+            indexed_cam_keys.update(cam.key for cam in new_cams)
+            cams_by_pc.update(_index_cameras_by_pointcloud(new_cams))
+
+            # Process each imported PC (some E57 may generate multiple assets)
+            for idx, new_pc in enumerate(new_pcs, start=1):
+
+                # Labeling
+                desired = f"{base}_new" if idx == 1 else f"{base}_new_{idx:02d}"
+                new_label = _make_unique_label(desired, existing_labels_lower)
+                new_pc.label = new_label
+                existing_labels_lower.add(_norm_name(new_pc.label))
+
+                # Put imported scan in the same group as the source (for consistent effective transforms)
+                try:
+                    if getattr(src, "group", None) is not None:
+                        new_pc.group = src.group
+                except Exception:
+                    pass
+
+                # (2) Imported transforms (raw). Read-only until DELTA is applied, so no copies needed
+                T_new0_pc = getattr(new_pc, "transform", None)
+                T_new0_eff = _effective_T(new_pc, T_new0_pc)
+
+                print(f"\nIMPORTED: '{new_pc.label}' (key={new_pc.key})")
+
+                if _DEBUG:
+                    print("\n(2) IMPORTED POINT CLOUD (RAW)")
+                    print("IMPORTED pc.transform:")
+                    print(_mat_to_str(T_new0_pc))
+                    print("IMPORTED effective (group*pc if applicable):")
+                    print(_mat_to_str(T_new0_eff))
+
+                if T_new0_eff is None:
+                    print("ERROR: Could not compute imported effective transform (T_new0_eff).")
+                    continue
+
+                # Delta so that DELTA * imported_eff == src_eff
+                delta = T_src_eff * _rigid_inv(T_new0_eff)
+
+                if _DEBUG:
+                    print("\nDELTA = SRC_eff * inv(IMPORTED_eff):")
+                    print(_mat_to_str(delta))
+
+                # Apply delta
+                _apply_delta_to_pc_transform(new_pc, delta, T_new0_pc)
+
+                # (3) Final transforms (only read back for debugging)
+                if _DEBUG:
+                    T_newF_pc = getattr(new_pc, "transform", None)
+                    T_newF_eff = _effective_T(new_pc, T_newF_pc)
+
+                    print("\n(3) IMPORTED POINT CLOUD (FINAL AFTER DELTA)")
+                    print("FINAL pc.transform:")
+                    print(_mat_to_str(T_newF_pc))
+                    print("FINAL effective (group*pc if applicable):")
+                    print(_mat_to_str(T_newF_eff))
+
+                # Operational: keep enabled state
+                try:
+                    new_pc.enabled = src.enabled
+                except Exception:
+                    pass
+
+                # --- Mask transfer: clear NEW masks, then copy masks from SRC station to NEW station ---
+                print("\n(4) MASK TRANSFER (SRC -> NEW)")
+                _transfer_masks_from_src_to_new(cams_by_pc, src, new_pc)
+
+            print("=" * 90)
 
 
 # Run